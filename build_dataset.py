@@ -5,38 +5,103 @@
 # What it does:
 # 1) Reads cities_200.csv (City, Country)
 # 2) Geocodes each city -> latitude/longitude (geopy Nominatim)
-# 3) Queries Meteostat monthly climate normals for the nearest station / point
+# 3) Looks up Meteostat monthly climate normals (1991–2020) from the nearest weather stations,
+#    kept in a local DuckDB file (meteostat.duckdb) so only new stations are downloaded
 # 4) Saves outputs:
 #    - dataset_monthly_normals.csv (°F temps + precipitation)
-#    - dataset_monthly_normals.json (for web)
+#    - dataset_monthly_normals.parquet (same data, one row per city and month)
+#    - dataset_monthly_normals.json (for web; one array per field, see README_PAGES.md)
+#    - dataset_monthly_normals.json.gz (gzipped copy of the JSON for hosting)
 #    - comfort_map_dropdown.html (interactive map with month selector + sliders)
+#    Use --formats to write only some of the data files, e.g. --formats json,parquet
 #
 # Requirements (install once):
-#   pip install meteostat geopy pandas jinja2 folium
+#   pip install meteostat duckdb scipy geopy aiohttp requests numpy pandas pyarrow orjson jinja2
 #
 # Note: Respect Nominatim's usage policy. This script adds a small delay between geocoding requests.
 
+import argparse
+import asyncio
+import base64
+import duckdb
+import gzip
+import os
+import re
+import sqlite3
 import time
-import json
+import warnings
 import math
+import numpy as np
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from pathlib import Path
 from typing import Dict, Any
-from meteostat import Point, Normals, Stations
-from geopy.geocoders import Nominatim
-from geopy.extra.rate_limiter import RateLimiter
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from meteostat import Normals, Stations
+from scipy.spatial import cKDTree
+from geopy.adapters import AioHTTPAdapter, RequestsAdapter
+from geopy.geocoders import GoogleV3, Nominatim
+from geopy.extra.rate_limiter import AsyncRateLimiter, RateLimiter
 from jinja2 import Template
-import folium
+from markupsafe import Markup
 
 DATA_CSV = "cities_200.csv"
 OUT_CSV = "dataset_monthly_normals.csv"
 OUT_JSON = "dataset_monthly_normals.json"
+OUT_JSON_GZ = OUT_JSON + ".gz"
+OUT_PARQUET = "dataset_monthly_normals.parquet"
 OUT_HTML = "comfort_map_dropdown.html"
+# Data files written by default; --formats picks a subset (the map is always built)
+OUTPUT_FORMATS = ("csv", "json", "parquet")
+GEOCODE_CACHE = "geocode_cache.sqlite"
+METEOSTAT_DB = "meteostat.duckdb"
+
+# The public Nominatim server allows at most 1 request/second. Only lower the
+# delay when NOMINATIM_DOMAIN points at a self-hosted or paid endpoint.
+NOMINATIM_DOMAIN = "nominatim.openstreetmap.org"
+GEOCODE_USER_AGENT = "nomad-comfort-map"
+GEOCODE_MIN_DELAY = 1
+# Set to False to geocode with the synchronous client (no aiohttp needed)
+GEOCODE_ASYNC = True
+# "nominatim" or "google" (GoogleV3, reads GOOGLE_API_KEY from the environment).
+# Google has no per-second delay, so lookups are only capped by GEOCODE_CONCURRENCY.
+GEOCODER = "nominatim"
+GEOCODE_CONCURRENCY = 100
+
+# Parallel Meteostat downloads when fetching normals for new stations
+NORMALS_WORKERS = 16
+NORMALS_PERIOD = (1991, 2020)
+# Same station choice Meteostat's Point(lat, lon) makes: stations within 35 km
+# whose elevation is within 350 m of the city's (guessed from the 4 nearest),
+# best 4 by a distance/altitude score. Each month/field comes from the
+# best-scored of them that has a value.
+STATION_RADIUS_M = 35000
+STATION_ALT_RANGE_M = 350
+STATION_WEIGHT_DIST = 0.6
+STATION_WEIGHT_ALT = 0.4
+# City coordinates are rounded to this many decimals (about 1 km) before the
+# station search, and resolved normals are reused for the same rounded point
+POINT_DECIMALS = 2
+EARTH_RADIUS_M = 6371000
+STATION_COUNT = 4
 
 COMFORT_MIN_F = 50
 COMFORT_MAX_F = 75
+COMFORT_MAX_PRCP_IN = 5
 
 MONTHS = ["Jan","Feb","Mar","Apr","May","Jun","Jul","Aug","Sep","Oct","Nov","Dec"]
+# Meteostat normals columns we keep: temperatures (°C) then precipitation (mm)
+NORMALS_COLUMNS = ["tavg", "tmin", "tmax", "prcp"]
+# Converted metrics as they appear in the outputs
+METRICS = ["tavg_f", "tmin_f", "tmax_f", "prcp_in"]
+# The map HTML ships metrics as Int16 fixed point: tenths of °F, hundredths of an inch
+PACK_SCALES = {"tavg_f": 10, "tmin_f": 10, "tmax_f": 10, "prcp_in": 100}
+INT16_MISSING = -32768
 
 def c_to_f(c):
     if c is None or (isinstance(c, float) and math.isnan(c)):
@@ -48,106 +113,486 @@ def mm_to_in(mm):
         return None
     return round(mm / 25.4, 2)
 
+def open_geocode_cache(path: str = GEOCODE_CACHE) -> sqlite3.Connection:
+    cache = sqlite3.connect(path)
+    cache.execute("CREATE TABLE IF NOT EXISTS geocode (key TEXT PRIMARY KEY, lat REAL, lon REAL)")
+    return cache
+
+def _cache_key(city: str, country: str) -> str:
+    # A miss only holds for the backend and query form that produced it, so
+    # switching either looks the city up again
+    return f"{GEOCODER}|structured|{city.strip().lower()}|{country.strip().lower()}"
+
+def _cached_coordinates(cache: sqlite3.Connection, key: str):
+    row = cache.execute("SELECT lat, lon FROM geocode WHERE key = ?", (key,)).fetchone()
+    # None means never looked up; (None, None) is a remembered miss
+    return None if row is None else tuple(row)
+
+def _cache_coordinates(cache: sqlite3.Connection, key: str, location):
+    coords = (location.latitude, location.longitude) if location else (None, None)
+    with cache:
+        cache.execute("INSERT OR REPLACE INTO geocode VALUES (?, ?, ?)", (key, *coords))
+    return coords
+
+def _set_coordinates(df: pd.DataFrame, coords) -> pd.DataFrame:
+    df['Lat'] = [lat for lat, _ in coords]
+    df['Lon'] = [lon for _, lon in coords]
+    return df
+
+def _make_geolocator(adapter_factory):
+    # Returns the geocoder and the minimum delay between its requests
+    if GEOCODER == "google":
+        return GoogleV3(api_key=os.environ["GOOGLE_API_KEY"], adapter_factory=adapter_factory), 0
+    return Nominatim(user_agent=GEOCODE_USER_AGENT, domain=NOMINATIM_DOMAIN,
+                     adapter_factory=adapter_factory), GEOCODE_MIN_DELAY
+
+def _structured_query(city: str, country: str):
+    # Structured queries match more cities on the first try than "City, Country",
+    # so the city-only fallback request is needed less often
+    if GEOCODER == "google":
+        return city, {"components": {"country": country}}
+    return {"city": city, "country": country}, {}
+
 def geocode_cities(df: pd.DataFrame) -> pd.DataFrame:
-    geolocator = Nominatim(user_agent="nomad-comfort-map")
-    geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1)
-    lats, lons = [], []
-    for _, row in df.iterrows():
-        query = f"{row['City']}, {row['Country']}"
-        location = geocode(query)
+    # RequestsAdapter keeps one requests.Session (geolocator.adapter.session)
+    # for every call, so keep-alive skips the TCP/TLS handshake after the first.
+    geolocator, min_delay = _make_geolocator(RequestsAdapter)
+    # Raise instead of returning None so network errors are not cached as misses
+    geocode = RateLimiter(geolocator.geocode, min_delay_seconds=min_delay,
+                          swallow_exceptions=False)
+    coords = []
+    with closing(open_geocode_cache()) as cache:
+        for _, row in df.iterrows():
+            city, country = row['City'], row['Country']
+            key = _cache_key(city, country)
+            cached = _cached_coordinates(cache, key)
+            if cached is not None:
+                coords.append(cached)
+                continue
+            try:
+                query, kwargs = _structured_query(city, country)
+                location = geocode(query, **kwargs)
+                if not location:
+                    # Try city only
+                    location = geocode(city)
+            except Exception as e:
+                print(f"Geocoding failed for {city}, {country}: {e}")
+                coords.append((None, None))
+                continue
+            coords.append(_cache_coordinates(cache, key, location))
+    return _set_coordinates(df, coords)
+
+async def _geocode_city(geocode, limit: asyncio.Semaphore, city: str, country: str):
+    async with limit:
+        query, kwargs = _structured_query(city, country)
+        location = await geocode(query, **kwargs)
         if not location:
             # Try city only
-            location = geocode(row['City'])
-        if location:
-            lats.append(location.latitude)
-            lons.append(location.longitude)
-        else:
-            lats.append(None)
-            lons.append(None)
-    df['Lat'] = lats
-    df['Lon'] = lons
-    return df
+            location = await geocode(city)
+        return location
+
+async def geocode_cities_async(df: pd.DataFrame) -> pd.DataFrame:
+    with closing(open_geocode_cache()) as cache:
+        keys = [_cache_key(city, country) for city, country in zip(df['City'], df['Country'])]
+        coords = [_cached_coordinates(cache, key) for key in keys]
+        misses = [i for i, cached in enumerate(coords) if cached is None]
+        if misses:
+            # All lookups are in flight at once; the rate limiter still spaces request
+            # starts by the geocoder's minimum delay, so the wait overlaps with network latency.
+            geolocator, min_delay = _make_geolocator(AioHTTPAdapter)
+            async with geolocator:
+                geocode = AsyncRateLimiter(geolocator.geocode, min_delay_seconds=min_delay,
+                                           swallow_exceptions=False)
+                limit = asyncio.Semaphore(GEOCODE_CONCURRENCY)
+                tasks = [_geocode_city(geocode, limit, df['City'].iat[i], df['Country'].iat[i]) for i in misses]
+                locations = await asyncio.gather(*tasks, return_exceptions=True)
+            for i, location in zip(misses, locations):
+                if isinstance(location, Exception):
+                    print(f"Geocoding failed for {df['City'].iat[i]}, {df['Country'].iat[i]}: {location}")
+                    coords[i] = (None, None)
+                else:
+                    coords[i] = _cache_coordinates(cache, keys[i], location)
+    return _set_coordinates(df, coords)
+
+def _setting_changed(db: duckdb.DuckDBPyConnection, name: str, value: str) -> bool:
+    # Records the value; files from before a setting was recorded count as changed
+    row = db.execute("SELECT value FROM settings WHERE name = ?", [name]).fetchone()
+    if row is not None and row[0] == value:
+        return False
+    db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)", [name, value])
+    return True
+
+def open_meteostat_db(path: str = METEOSTAT_DB) -> duckdb.DuckDBPyConnection:
+    db = duckdb.connect(path)
+    columns = {name for (name,) in db.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_name = 'stations'"
+    ).fetchall()}
+    if "elevation" not in columns:
+        # One bulk download of the full station list (id, coordinates, elevation);
+        # files written before elevation was kept are rebuilt as well
+        stations = Stations().fetch().reset_index()[["id", "latitude", "longitude", "elevation"]]
+        db.register("all_stations", stations)
+        db.execute("""
+            CREATE OR REPLACE TABLE stations AS
+            SELECT id, latitude, longitude, elevation FROM all_stations
+            WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        """)
+        db.unregister("all_stations")
+        # Points resolved against the old station list are searched again
+        db.execute("DROP TABLE IF EXISTS point_normals")
+    # Stored normals are only valid for the settings they were built with
+    db.execute("CREATE TABLE IF NOT EXISTS settings (name VARCHAR PRIMARY KEY, value VARCHAR)")
+    if _setting_changed(db, "normals_period", repr(NORMALS_PERIOD)):
+        for table in ("normals", "fetched", "point_normals"):
+            db.execute(f"DROP TABLE IF EXISTS {table}")
+    point_search = (STATION_RADIUS_M, STATION_COUNT, STATION_ALT_RANGE_M,
+                    STATION_WEIGHT_DIST, STATION_WEIGHT_ALT, POINT_DECIMALS)
+    if _setting_changed(db, "point_search", repr(point_search)):
+        db.execute("DROP TABLE IF EXISTS point_normals")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS normals (
+            station VARCHAR, month INTEGER, tavg DOUBLE, tmin DOUBLE, tmax DOUBLE, prcp DOUBLE
+        )
+    """)
+    # Stations whose normals Meteostat has answered for, including those without any
+    db.execute("CREATE TABLE IF NOT EXISTS fetched (station VARCHAR PRIMARY KEY)")
+    # Resolved normals per city location, keyed on coordinates rounded to POINT_DECIMALS
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS point_normals (
+            lat DOUBLE, lon DOUBLE, month INTEGER, tavg DOUBLE, tmin DOUBLE, tmax DOUBLE, prcp DOUBLE
+        )
+    """)
+    return db
+
+CACHED_POINT_NORMALS_SQL = """
+SELECT l.idx, p.month, p.tavg, p.tmin, p.tmax, p.prcp
+FROM located l JOIN point_normals p ON p.lat = l.lat AND p.lon = l.lon
+"""
+
+STORE_POINT_NORMALS_SQL = """
+INSERT INTO point_normals
+SELECT DISTINCT ON (l.lat, l.lon, r.month) l.lat, l.lon, r.month, r.tavg, r.tmin, r.tmax, r.prcp
+FROM resolved r JOIN located l ON l.idx = r.idx
+-- Points with a candidate station whose download failed are searched again next run
+WHERE NOT EXISTS (
+    SELECT 1 FROM candidates k
+    WHERE k.idx = r.idx AND k.station NOT IN (SELECT station FROM fetched)
+)
+"""
+
+CITY_NORMALS_SQL = """
+SELECT k.idx, n.month,
+       any_value(n.tavg ORDER BY k.rank) AS tavg,
+       any_value(n.tmin ORDER BY k.rank) AS tmin,
+       any_value(n.tmax ORDER BY k.rank) AS tmax,
+       any_value(n.prcp ORDER BY k.rank) AS prcp
+FROM candidates k JOIN normals n ON n.station = k.station
+GROUP BY k.idx, n.month
+"""
+
+def _unit_vectors(lat, lon) -> np.ndarray:
+    lat, lon = np.deg2rad(np.asarray(lat, dtype=np.float64)), np.deg2rad(np.asarray(lon, dtype=np.float64))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+def nearby_stations(db: duckdb.DuckDBPyConnection, located: pd.DataFrame) -> pd.DataFrame:
+    # Point's station choice for every city in one pass; located has idx, lat, lon.
+    # Straight-line (chord) distance between points on the unit sphere grows
+    # with great-circle distance, so a KD-tree over 3D unit vectors finds the
+    # stations within the radius without a haversine scan per city.
+    stations = db.execute("SELECT id, latitude, longitude, elevation FROM stations").df()
+    if located.empty or stations.empty:
+        return pd.DataFrame({"idx": [], "station": [], "rank": []})
+    tree = cKDTree(_unit_vectors(stations["latitude"], stations["longitude"]))
+    points = _unit_vectors(located["lat"], located["lon"])
+    max_chord = 2 * np.sin(STATION_RADIUS_M / (2 * EARTH_RADIUS_M))
+    hits = tree.query_ball_point(points, max_chord)
+    rows = np.repeat(np.arange(len(located)), [len(h) for h in hits])
+    cols = np.concatenate([np.asarray(h, dtype=np.intp) for h in hits])
+    chord = np.linalg.norm(points[rows] - tree.data[cols], axis=1)
+    near = pd.DataFrame({
+        "idx": located["idx"].to_numpy()[rows],
+        "station": stations["id"].to_numpy()[cols],
+        "distance": 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(chord / 2, 1)),
+        "elevation": stations["elevation"].to_numpy()[cols],
+    }).sort_values(["idx", "distance"], kind="stable")
+    # No altitude is given, so like Point the city's is the mean elevation of
+    # its STATION_COUNT nearest stations; only stations close to it are kept
+    alt = near.groupby("idx").head(STATION_COUNT).groupby("idx")["elevation"].mean()
+    gap = (near["elevation"] - near["idx"].map(alt)).abs()
+    near = near.assign(score=(1 - near["distance"] / STATION_RADIUS_M) * STATION_WEIGHT_DIST
+                             + (1 - gap / STATION_ALT_RANGE_M) * STATION_WEIGHT_ALT)
+    near = (near[gap <= STATION_ALT_RANGE_M]
+            .sort_values(["idx", "score"], ascending=[True, False], kind="stable")
+            .groupby("idx").head(STATION_COUNT))
+    return pd.DataFrame({
+        "idx": near["idx"].to_numpy(),
+        "station": near["station"].to_numpy(),
+        "rank": near.groupby("idx").cumcount().to_numpy() + 1,
+    })
+
+# Meteostat turns every HTTP error (404 as well as 429 or 5xx) into an empty
+# frame and this warning
+LOAD_FAILED = re.compile(r"Cannot load normals/(.+?)\.csv\.gz from")
+
+def _has_no_normals_file(station: str) -> bool:
+    # True only for a definite 404, so throttled or failed downloads are retried
+    try:
+        with urlopen(Request(f"{Normals.endpoint}normals/{station}.csv.gz", method="HEAD"), timeout=30):
+            return False
+    except HTTPError as e:
+        return e.code == 404
+    except OSError:
+        return False
+
+def ensure_normals(db: duckdb.DuckDBPyConnection, stations) -> None:
+    fetched = {station for (station,) in db.execute("SELECT station FROM fetched").fetchall()}
+    missing = sorted(set(stations) - fetched)
+    if not missing:
+        return
+    print(f"Downloading normals for {len(missing)} weather stations...")
+    Normals.threads = NORMALS_WORKERS
+    # Meteostat's file cache would hand a failed download back as an empty
+    # frame without the warning; the DuckDB tables are the cache here
+    Normals.max_age = 0
+    try:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            df = Normals(missing, *NORMALS_PERIOD).fetch()
+    except (OSError, EOFError) as e:
+        # Meteostat only absorbs HTTP errors; a timeout, reset connection or
+        # broken gzip on any station aborts the whole batch. Record none of
+        # them so they are retried, and let cities resolve from what is stored.
+        print(f"Could not download normals ({e}); {len(missing)} stations will be retried on the next run")
+        return
+    failed = sorted({m.group(1) for w in caught if (m := LOAD_FAILED.search(str(w.message)))})
+    absent = set()
+    if failed:
+        with ThreadPoolExecutor(max_workers=NORMALS_WORKERS) as ex:
+            absent = {station for station, gone in zip(failed, ex.map(_has_no_normals_file, failed)) if gone}
+        if len(absent) < len(failed):
+            print(f"Could not download normals for {len(failed) - len(absent)} stations; they will be retried on the next run")
+    done = [station for station in missing if station not in failed or station in absent]
+    # Normals and their fetched markers land together, so an interrupted run
+    # never leaves rows that the next run would download and insert again
+    db.begin()
+    try:
+        if not df.empty:
+            df = df.reset_index()
+            if "station" not in df.columns:
+                # Meteostat drops the station level when only one was requested
+                df["station"] = missing[0]
+            db.register("new_normals", df.reindex(columns=["station", "month", *NORMALS_COLUMNS]))
+            db.execute("INSERT INTO normals SELECT station, CAST(month AS INTEGER), tavg, tmin, tmax, prcp FROM new_normals")
+            db.unregister("new_normals")
+        if done:
+            db.executemany("INSERT INTO fetched VALUES (?)", [(station,) for station in done])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
 
-def fetch_normals_for_point(lat: float, lon: float) -> Dict[str, Any]:
-    # Meteostat normals: 1991–2020 (default) or 1981–2010 depending on API version
-    # We'll use Point-based normals; falls back to nearest station grid
-    point = Point(lat, lon)
-    normals = Normals(point)
-    # 'Normals' returns a DataFrame with index 1..12 months and columns:
-    # tavg, tmin, tmax (°C), prcp (mm), wdir, wspd, pres, tsun, etc. (availability depends)
-    df = normals.fetch()
+def fetch_city_normals(db: duckdb.DuckDBPyConnection, cities: pd.DataFrame) -> Dict[int, pd.DataFrame]:
+    # Returns month-indexed normals (°C, mm) keyed by the city's row position
+    located = pd.DataFrame({
+        "idx": np.arange(len(cities)),
+        "lat": pd.to_numeric(cities['Lat'], errors="coerce").round(POINT_DECIMALS).to_numpy(),
+        "lon": pd.to_numeric(cities['Lon'], errors="coerce").round(POINT_DECIMALS).to_numpy(),
+    }).dropna()
+    db.register("located", located)
+    result = db.execute(CACHED_POINT_NORMALS_SQL).df()
+    # Only points seen for the first time need the station search
+    new_points = located[~located["idx"].isin(result["idx"])]
+    if not new_points.empty:
+        candidates = nearby_stations(db, new_points)
+        ensure_normals(db, candidates["station"].unique().tolist())
+        db.register("candidates", candidates)
+        resolved = db.execute(CITY_NORMALS_SQL).df()
+        db.register("resolved", resolved)
+        db.execute(STORE_POINT_NORMALS_SQL)
+        db.unregister("resolved")
+        db.unregister("candidates")
+        result = pd.concat([result, resolved], ignore_index=True)
+    db.unregister("located")
+    return {int(idx): g.set_index("month")[NORMALS_COLUMNS] for idx, g in result.groupby("idx")}
+
+def convert_normals(df: pd.DataFrame):
+    # df: index months 1..12, columns tavg, tmin, tmax (°C), prcp (mm).
+    # Returns a months x METRICS array in °F / inches, or None if incomplete.
     # Ensure we have 12 rows; if missing, return empty
     if df is None or df.empty or len(df.index) < 12:
-        return {}
-    # Build dictionaries
-    tavg_f = {MONTHS[i-1]: c_to_f(df.loc[i, 'tavg']) if 'tavg' in df.columns else None for i in range(1,13)}
-    tmin_f = {MONTHS[i-1]: c_to_f(df.loc[i, 'tmin']) if 'tmin' in df.columns else None for i in range(1,13)}
-    tmax_f = {MONTHS[i-1]: c_to_f(df.loc[i, 'tmax']) if 'tmax' in df.columns else None for i in range(1,13)}
-    prcp_in = {MONTHS[i-1]: mm_to_in(df.loc[i, 'prcp']) if 'prcp' in df.columns else None for i in range(1,13)}
-    return {"tavg_f": tavg_f, "tmin_f": tmin_f, "tmax_f": tmax_f, "prcp_in": prcp_in}
-
-def main():
+        return None
+    # Convert all months at once; missing months or columns come through as NaN
+    arr = df.reindex(index=range(1, 13), columns=NORMALS_COLUMNS).to_numpy(dtype=np.float64)
+    return np.column_stack([np.round(arr[:, :3] * 9/5 + 32, 1), np.round(arr[:, 3] / 25.4, 2)])
+
+def process_city(row: pd.Series, station_normals: pd.DataFrame):
+    city = row['City']
+    country = row['Country']
+    lat, lon = row.get('Lat'), row.get('Lon')
+    if pd.isna(lat) or pd.isna(lon):
+        print(f"Skipping {city}, {country} (no coordinates)")
+        return None
+    try:
+        normals = convert_normals(station_normals)
+        if normals is None:
+            print(f"No normals returned for {city}, {country}")
+        return normals
+    except Exception as e:
+        print(f"Error for {city}, {country}: {e}")
+        return None
+
+# The outputs below are all built from the same arrays: `kept` holds the City,
+# Country, Lat, Lon of the cities with data and `values` their normals as a
+# cities x months x METRICS float array (NaN = missing).
+
+def to_wide_frame(kept: pd.DataFrame, values: np.ndarray) -> pd.DataFrame:
+    # The CSV layout: one row per city, then <Month>_<metric> for every month.
+    # The numeric block goes in column-major (Fortran) order so each column is
+    # contiguous in memory for per-column scans and reductions.
+    columns = [f"{m}_{metric}" for m in MONTHS for metric in METRICS]
+    numeric = np.asfortranarray(values.reshape(len(kept), -1))
+    df = pd.DataFrame(numeric, columns=columns)
+    for pos, col in enumerate(("City", "Country", "Lat", "Lon")):
+        df.insert(pos, col, kept[col].to_numpy())
+    return df
+
+def to_columns(kept: pd.DataFrame, values: np.ndarray) -> Dict[str, Any]:
+    # Parallel arrays with one entry per city: the keys and month names are
+    # written once for the whole dataset instead of once per city.
+    # orjson writes the NaNs as null.
+    payload = {key: kept[col].tolist() for key, col in (("city", "City"), ("country", "Country"), ("lat", "Lat"), ("lon", "Lon"))}
+    for k, metric in enumerate(METRICS):
+        payload[metric] = {m: values[:, j, k].tolist() for j, m in enumerate(MONTHS)}
+    return payload
+
+def to_long_frame(kept: pd.DataFrame, values: np.ndarray) -> pd.DataFrame:
+    # One row per (city, month) so columnar readers can load just the
+    # metrics or months they need
+    n = len(kept)
+    frame = {
+        "city": np.repeat(kept["City"].to_numpy(), 12),
+        "country": np.repeat(kept["Country"].to_numpy(), 12),
+        "lat": np.repeat(kept["Lat"].to_numpy(dtype=np.float64), 12),
+        "lon": np.repeat(kept["Lon"].to_numpy(dtype=np.float64), 12),
+        "month": pd.Categorical(np.tile(MONTHS, n), categories=MONTHS, ordered=True),
+    }
+    # cities x months is already city-major row order
+    rows = values.reshape(n * 12, len(METRICS))
+    for k, metric in enumerate(METRICS):
+        frame[metric] = rows[:, k]
+    return pd.DataFrame(frame)
+
+def pack_int16(values: np.ndarray, scale: int) -> str:
+    # values is months x cities (NaN = missing); the result is base64 of
+    # little-endian Int16s in the same month-major order
+    scaled = values * scale
+    packed = np.where(np.isnan(scaled), INT16_MISSING, np.clip(np.round(scaled), -32767, 32767))
+    return base64.b64encode(packed.astype("<i2").tobytes()).decode("ascii")
+
+def comfort_masks(values: np.ndarray) -> str:
+    # Which cities pass the default filter, as one bitset row per month (bit i
+    # of the row = city i, least significant bit first), base64-encoded
+    tavg = values[:, :, METRICS.index("tavg_f")].T
+    prcp = values[:, :, METRICS.index("prcp_in")].T
+    ok = (tavg >= COMFORT_MIN_F) & (tavg <= COMFORT_MAX_F) & (np.isnan(prcp) | (prcp <= COMFORT_MAX_PRCP_IN))
+    return base64.b64encode(np.packbits(ok, axis=1, bitorder="little").tobytes()).decode("ascii")
+
+def to_map_payload(json_payload, values: np.ndarray) -> Dict[str, Any]:
+    # Names and coordinates stay plain JSON; the 12-per-city metrics are packed
+    payload = {key: json_payload[key] for key in ("city", "country", "lat", "lon")}
+    payload["scale"] = PACK_SCALES
+    payload["packed"] = {
+        metric: pack_int16(values[:, :, k].T, PACK_SCALES[metric])
+        for k, metric in enumerate(METRICS)
+    }
+    payload["default_filter"] = [COMFORT_MIN_F, COMFORT_MAX_F, COMFORT_MAX_PRCP_IN]
+    payload["default_mask"] = comfort_masks(values)
+    return payload
+
+def script_json(data: bytes) -> Markup:
+    # Same escaping as Jinja's tojson filter, so the JSON is safe inside <script>
+    text = data.decode("utf-8")
+    for char, escaped in (("<", "\\u003c"), (">", "\\u003e"), ("&", "\\u0026"), ("'", "\\u0027")):
+        text = text.replace(char, escaped)
+    return Markup(text)
+
+def parse_formats(text: str):
+    formats = [f.strip().lower() for f in text.split(",") if f.strip()]
+    unknown = sorted(set(formats) - set(OUTPUT_FORMATS))
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            f"unknown format(s): {', '.join(unknown)} (choose from {', '.join(OUTPUT_FORMATS)})"
+        )
+    return formats
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the monthly normals dataset and comfort map.")
+    parser.add_argument(
+        "--formats", type=parse_formats, default=list(OUTPUT_FORMATS),
+        help=f"comma-separated data files to write (default: {','.join(OUTPUT_FORMATS)})",
+    )
+    return parser.parse_args()
+
+def main(formats=OUTPUT_FORMATS):
     cities = pd.read_csv(DATA_CSV)
-    if 'Lat' not in cities.columns or 'Lon' not in cities.columns:
-        print("Geocoding cities (this may take several minutes; one request per second)...")
-        cities = geocode_cities(cities)
+    for col in ('Lat', 'Lon'):
+        if col not in cities.columns:
+            cities[col] = np.nan
+    # Geocode only the rows still without coordinates (new cities, earlier
+    # failures); the geocode cache answers any it has already looked up
+    todo = cities['Lat'].isna() | cities['Lon'].isna()
+    if todo.any():
+        print(f"Geocoding {todo.sum()} cities (this may take several minutes; one request per second)...")
+        pending = cities.loc[todo, ['City', 'Country']].copy()
+        if GEOCODE_ASYNC:
+            pending = asyncio.run(geocode_cities_async(pending))
+        else:
+            pending = geocode_cities(pending)
+        cities.loc[todo, ['Lat', 'Lon']] = pending[['Lat', 'Lon']].to_numpy(dtype=np.float64)
         cities.to_csv(DATA_CSV, index=False)
         print("Geocoding complete and saved back to cities_200.csv")
 
-    records = []
-    json_payload = []
-    for _, row in cities.iterrows():
-        city = row['City']
-        country = row['Country']
-        lat, lon = row.get('Lat'), row.get('Lon')
-        if pd.isna(lat) or pd.isna(lon):
-            print(f"Skipping {city}, {country} (no coordinates)")
-            continue
-        try:
-            normals = fetch_normals_for_point(lat, lon)
-            if not normals:
-                print(f"No normals returned for {city}, {country}")
-                continue
-            # Build a single CSV row with average temps
-            out_row = {
-                "City": city, "Country": country, "Lat": lat, "Lon": lon
-            }
-            # Use tavg_f; also include tmin/tmax/prcp for completeness
-            for m in MONTHS:
-                out_row[f"{m}_tavg_f"] = normals["tavg_f"][m]
-                out_row[f"{m}_tmin_f"] = normals["tmin_f"][m]
-                out_row[f"{m}_tmax_f"] = normals["tmax_f"][m]
-                out_row[f"{m}_prcp_in"] = normals["prcp_in"][m]
-            records.append(out_row)
-
-            # JSON payload for the web map (tavg_f + prcp_in)
-            json_payload.append({
-                "city": city,
-                "country": country,
-                "lat": lat,
-                "lon": lon,
-                "tavg_f": normals["tavg_f"],
-                "tmin_f": normals["tmin_f"],
-                "tmax_f": normals["tmax_f"],
-                "prcp_in": normals["prcp_in"],
-            })
-        except Exception as e:
-            print(f"Error for {city}, {country}: {e}")
-            continue
-
-    if not records:
+    try:
+        with closing(open_meteostat_db()) as db:
+            normals = fetch_city_normals(db, cities)
+    except Exception as e:
+        print(f"Error fetching normals: {e}")
+        normals = {}
+    # Fill one preallocated array instead of collecting per-city dicts
+    values = np.full((len(cities), len(MONTHS), len(METRICS)), np.nan)
+    found = np.zeros(len(cities), dtype=bool)
+    for idx, (_, row) in enumerate(cities.iterrows()):
+        block = process_city(row, normals.get(idx))
+        if block is not None:
+            values[idx] = block
+            found[idx] = True
+
+    if not found.any():
         print("No data collected. Please check your internet connection/API availability and try again.")
         return
 
-    df = pd.DataFrame(records)
-    df.to_csv(OUT_CSV, index=False)
-    with open(OUT_JSON, "w", encoding="utf-8") as f:
-        json.dump(json_payload, f, ensure_ascii=False)
+    kept = cities.loc[found, ['City', 'Country', 'Lat', 'Lon']]
+    values = values[found]
+    json_payload = to_columns(kept, values)
+    written = []
+    if "csv" in formats:
+        # Arrow's C++ writer instead of DataFrame.to_csv (it quotes all text fields)
+        pa_csv.write_csv(pa.Table.from_pandas(to_wide_frame(kept, values), preserve_index=False), OUT_CSV)
+        written.append(f"CSV: {OUT_CSV}")
+    if "parquet" in formats:
+        to_long_frame(kept, values).to_parquet(OUT_PARQUET, index=False, compression="zstd")
+        written.append(f"Parquet: {OUT_PARQUET}")
+    if "json" in formats:
+        # orjson writes UTF-8 bytes directly
+        payload_json = orjson.dumps(json_payload, option=orjson.OPT_SERIALIZE_NUMPY)
+        with open(OUT_JSON, "wb") as f:
+            f.write(payload_json)
+        # Pre-compressed copy for hosting (index.html fetches it and decompresses in the browser)
+        with gzip.open(OUT_JSON_GZ, "wb", compresslevel=6) as f:
+            f.write(payload_json)
+        written.append(f"JSON: {OUT_JSON} (+ {OUT_JSON_GZ})")
 
     # Build interactive HTML (Leaflet + dropdown + sliders)
-    with open(OUT_JSON, "r", encoding="utf-8") as f:
-        city_data = json.load(f)
-
     html_template = Template(r"""
 <!DOCTYPE html>
 <html>
@@ -155,7 +600,10 @@ def main():
   <meta charset="utf-8" />
   <title>Nomad Comfort Map (Monthly Normals)</title>
   <link rel="stylesheet" href="https://unpkg.com/leaflet/dist/leaflet.css" />
+  <link rel="stylesheet" href="https://unpkg.com/leaflet.markercluster/dist/MarkerCluster.css" />
+  <link rel="stylesheet" href="https://unpkg.com/leaflet.markercluster/dist/MarkerCluster.Default.css" />
   <script src="https://unpkg.com/leaflet/dist/leaflet.js"></script>
+  <script src="https://unpkg.com/leaflet.markercluster/dist/leaflet.markercluster.js"></script>
   <style>
     html, body { height: 100%; margin: 0; font-family: system-ui, -apple-system, Segoe UI, Roboto, sans-serif; }
     #toolbar { padding: 10px; background: #f7f7f7; border-bottom: 1px solid #e2e2e2; display: flex; gap: 12px; align-items: center; flex-wrap: wrap; }
@@ -183,7 +631,7 @@ def main():
     </div>
     <div class="pill">
       <label for="maxPrcp">Max monthly precip (in):</label>
-      <input id="maxPrcp" type="number" value="5" step="0.1" />
+      <input id="maxPrcp" type="number" value="{{ comfort_max_prcp }}" step="0.1" />
     </div>
     <div class="pill">
       <button id="apply">Apply Filters</button>
@@ -192,15 +640,48 @@ def main():
   <div id="map"></div>
 
   <script>
-    const cityData = {{ city_data | tojson }};
-    const months = {{ months | tojson }};
+    const cityData = {{ city_data_js }};
+    const months = {{ months_js }};
 
     const map = L.map('map').setView([20, 0], 2);
     L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
       attribution: '&copy; OpenStreetMap contributors'
     }).addTo(map);
 
-    let markers = [];
+    // Markers are drawn on one shared canvas and grouped into clusters,
+    // so a filter change is one clearLayers() + one addLayers() call
+    const renderer = L.canvas();
+    const cluster = L.markerClusterGroup();
+    map.addLayer(cluster);
+
+    // Metrics arrive as base64 little-endian Int16 blocks (months x cities) in
+    // fixed-point units of cityData.scale; -32768 marks a missing value.
+    // Decode them once into per-month Float64Array views (NaN = no data) so
+    // update() scans contiguous numbers instead of looking up keys per city.
+    const N = cityData.city.length;
+    function unpack(b64, scale) {
+      const bytes = Uint8Array.from(atob(b64), ch => ch.charCodeAt(0));
+      const ints = new Int16Array(bytes.buffer);
+      const values = new Float64Array(ints.length);
+      for (let i = 0; i < ints.length; i++) {
+        values[i] = ints[i] === -32768 ? NaN : ints[i] / scale;
+      }
+      return values;
+    }
+    const byMonth = {};
+    Object.keys(cityData.packed).forEach(k => {
+      const values = unpack(cityData.packed[k], cityData.scale[k]);
+      byMonth[k] = {};
+      months.forEach((m, j) => { byMonth[k][m] = values.subarray(j * N, (j + 1) * N); });
+    });
+    const fmt = v => isNaN(v) ? "n/a" : v;
+
+    // Cities passing the default filter, precomputed per month as bitsets
+    // (rowBytes bytes per month, bit i = city i) so the initial view and any
+    // return to the default values skip the comparisons entirely
+    const rowBytes = Math.ceil(N / 8);
+    const defaultMask = Uint8Array.from(atob(cityData.default_mask), ch => ch.charCodeAt(0));
+    const [defaultMin, defaultMax, defaultPrcp] = cityData.default_filter;
 
     function update() {
       const m = document.getElementById('month').value;
@@ -209,29 +690,43 @@ def main():
       const maxP = parseFloat(document.getElementById('maxPrcp').value);
 
       // Clear existing markers
-      markers.forEach(marker => map.removeLayer(marker));
-      markers = [];
-
-      cityData.forEach(c => {
-        const t = c.tavg_f[m];
-        const p = c.prcp_in[m];
-        if (t == null) return;
-        const tempOk = (t >= tmin && t <= tmax);
-        const prcpOk = (p == null) ? true : (p <= maxP);
-
-        if (tempOk && prcpOk) {
-          const marker = L.marker([c.lat, c.lon]).addTo(map);
-          const details = `
-            <b>${c.city}, ${c.country}</b><br>
-            <b>${m}</b><br>
-            Avg: ${t} °F<br>
-            Min/Max: ${c.tmin_f[m]} / ${c.tmax_f[m]} °F<br>
-            Precip: ${p ?? "n/a"} in
-          `;
-          marker.bindPopup(details);
-          markers.push(marker);
+      cluster.clearLayers();
+      const markers = [];
+
+      const tavg = byMonth.tavg_f[m];
+      const prcp = byMonth.prcp_in[m];
+      function addMarker(i) {
+        const marker = L.circleMarker([cityData.lat[i], cityData.lon[i]], { renderer, radius: 6 });
+        const details = `
+          <b>${cityData.city[i]}, ${cityData.country[i]}</b><br>
+          <b>${m}</b><br>
+          Avg: ${tavg[i]} °F<br>
+          Min/Max: ${fmt(byMonth.tmin_f[m][i])} / ${fmt(byMonth.tmax_f[m][i])} °F<br>
+          Precip: ${fmt(prcp[i])} in
+        `;
+        marker.bindPopup(details);
+        markers.push(marker);
+      }
+
+      if (tmin === defaultMin && tmax === defaultMax && maxP === defaultPrcp) {
+        const row = months.indexOf(m) * rowBytes;
+        for (let b = 0; b < rowBytes; b++) {
+          // Visit only the set bits, lowest first
+          for (let bits = defaultMask[row + b]; bits; bits &= bits - 1) {
+            addMarker(b * 8 + 31 - Math.clz32(bits & -bits));
+          }
+        }
+      } else {
+        for (let i = 0; i < N; i++) {
+          const t = tavg[i];
+          // A missing temperature (NaN) fails both comparisons
+          if (!(t >= tmin && t <= tmax)) continue;
+          const p = prcp[i];
+          if (!(isNaN(p) || p <= maxP)) continue;
+          addMarker(i);
         }
-      });
+      }
+      cluster.addLayers(markers);
     }
 
     document.getElementById('apply').addEventListener('click', update);
@@ -245,17 +740,20 @@ def main():
     """)
 
     html = html_template.render(
-        city_data=city_data,
+        city_data_js=script_json(orjson.dumps(to_map_payload(json_payload, values), option=orjson.OPT_SERIALIZE_NUMPY)),
+        months_js=script_json(orjson.dumps(MONTHS)),
         months=MONTHS,
         comfort_min=COMFORT_MIN_F,
-        comfort_max=COMFORT_MAX_F
+        comfort_max=COMFORT_MAX_F,
+        comfort_max_prcp=COMFORT_MAX_PRCP_IN
     )
 
     with open(OUT_HTML, "w", encoding="utf-8") as f:
         f.write(html)
 
-    print(f"Done.\n- CSV: {OUT_CSV}\n- JSON: {OUT_JSON}\n- Map: {OUT_HTML}")
+    written.append(f"Map: {OUT_HTML}")
+    print("Done.\n" + "\n".join(f"- {w}" for w in written))
     print("Tip: open comfort_map_dropdown.html in your browser.")
 
 if __name__ == "__main__":
-    main()
+    main(parse_args().formats)